@@ -1,178 +1,408 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-import base64
+from pydantic import BaseModel, ConfigDict
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Callable, Literal, NamedTuple
+from contextlib import asynccontextmanager
+import asyncio
+import functools
+import hashlib
 import io
 import logging
-from qiskit import QuantumCircuit
+import threading
+import uuid
+import numpy as np
+from qiskit import QuantumCircuit, transpile
 from qiskit_aer import AerSimulator
-from qiskit.visualization import plot_histogram
+from qiskit.quantum_info import Statevector
 from qiskit.circuit.library import GroverOperator
-import matplotlib
-matplotlib.use('Agg')  # Set non-interactive backend
-import matplotlib.pyplot as plt
+
+# pyplot is not thread-safe, so all matplotlib rendering from worker threads
+# goes through _MPL_LOCK.
+_MPL_LOCK = threading.Lock()
+
+@functools.cache
+def _pyplot():
+    """Import pyplot on first use; text diagrams never need matplotlib."""
+    import matplotlib
+    matplotlib.use('Agg')  # Set non-interactive backend
+    import matplotlib.pyplot as plt
+    return plt
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # Warm matplotlib (font manager, text layout) before the first request
+    await asyncio.to_thread(_warm_renderer)
+    yield
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-# In-memory circuit state
-circuit_state = {"circuit": None, "gates": [], "qubits": 2}
+# index.html is static, so read it once at startup
+with open("templates/index.html", "r") as f:
+    _INDEX_HTML = f.read()
+
+# Shared simulator backend, built once and reused across requests
+SIMULATOR = AerSimulator()
+
+# Largest supported circuit; validation and the example pre-renders both use it
+MAX_QUBITS = 5
+
+# In-memory circuit state, one per browser session; least recently used
+# sessions are evicted once MAX_SESSIONS is reached
+SESSION_COOKIE = "session_id"
+MAX_SESSIONS = 1000
+
+@dataclass
+class SessionState:
+    gates: list = field(default_factory=list)
+    qubits: int = 2
+    last_circuit_image: str | None = None
+    last_circuit_format: str = "text"
+
+    def remember_circuit_image(self, circuit_image, circuit_format):
+        self.last_circuit_image = circuit_image
+        self.last_circuit_format = circuit_format
+
+sessions: OrderedDict[str, SessionState] = OrderedDict()
+
+# The session dependencies are async so every access to `sessions` stays on the
+# event loop; sync dependencies would run in worker threads and race on it.
+def _lookup_session(request):
+    session_id = request.cookies.get(SESSION_COOKIE)
+    session = sessions.get(session_id)
+    if session is not None:
+        sessions.move_to_end(session_id)
+    return session
+
+async def get_session(request: Request, response: Response):
+    """Yield the caller's session, creating one if needed (endpoints that modify it).
+
+    A new session is only stored once the handler succeeds, since a failed
+    request never delivers its Set-Cookie header.
+    """
+    session = _lookup_session(request)
+    if session is not None:
+        yield session
+        return
+    session_id = uuid.uuid4().hex
+    session = SessionState()
+    response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="lax")
+    yield session
+    sessions[session_id] = session
+    while len(sessions) > MAX_SESSIONS:
+        sessions.popitem(last=False)
+
+async def find_session(request: Request) -> SessionState:
+    """Look up the caller's session without creating one (read-only endpoints)."""
+    session = _lookup_session(request)
+    if session is None:
+        raise HTTPException(status_code=400, detail="No circuit defined")
+    return session
+
+class GateType(str, Enum):
+    H = "H (Hadamard)"
+    X = "X (Pauli-X)"
+    CX = "CX (CNOT)"
+    CZ = "CZ (Controlled-Z)"
+    MEASURE = "Measure"
+
+class ExampleName(str, Enum):
+    BELL = "Bell State (Entanglement)"
+    GROVER = "Grover's Algorithm (2-Qubit Search)"
 
 class GateRequest(BaseModel):
-    gate_type: str
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
+    gate_type: GateType
     target_qubit: int | None = None
     control_qubit: int | None = None
     qubits: int
 
-def circuit_to_base64(circuit, is_histogram=False):
+# Declared response models let FastAPI serialize straight to JSON bytes in pydantic-core
+class CircuitResponse(BaseModel):
+    gates: list[tuple]
+    circuit_image: str | None
+    circuit_format: Literal['text', 'png'] = 'text'
+
+class SimulationResponse(BaseModel):
+    circuit_image: str | None
+    circuit_format: Literal['text', 'png']
+    counts: dict[str, int]
+    shots: int
+
+class GateSpec(NamedTuple):
+    name: str  # first element of the stored gate record
+    apply: Callable  # (circuit, record, qubits) -> None
+    needs_target: bool
+    needs_control: bool
+
+    def record(self, target, control):
+        if self.needs_control:
+            return (self.name, control, target)
+        if self.needs_target:
+            return (self.name, target)
+        return (self.name, "All")
+
+GATE_DISPATCH = {
+    GateType.H: GateSpec("H", lambda c, g, _: c.h(g[1]), True, False),
+    GateType.X: GateSpec("X", lambda c, g, _: c.x(g[1]), True, False),
+    GateType.CX: GateSpec("CX", lambda c, g, _: c.cx(g[1], g[2]), True, True),
+    GateType.CZ: GateSpec("CZ", lambda c, g, _: c.cz(g[1], g[2]), True, True),
+    GateType.MEASURE: GateSpec("Measure", lambda c, _, n: c.measure(range(n), range(n)), False, False),
+}
+
+def _make_grover_op():
+    oracle = QuantumCircuit(2)
+    oracle.cz(0, 1)
+    return GroverOperator(oracle).to_instruction()
+
+# Built once; GroverOperator construction and conversion are comparatively slow
+_GROVER_OP = _make_grover_op()
+
+# record name -> applier used by _build_circuit; the Grover operator only comes from examples
+_APPLY_GATE = {spec.name: spec.apply for spec in GATE_DISPATCH.values()}
+_APPLY_GATE["Grover Operator"] = lambda c, g, _: c.append(_GROVER_OP, list(g[1]))
+
+def _freeze_gates(gates):
+    """Convert a gate list into a hashable tuple of tuples (lists become tuples)."""
+    return tuple(
+        tuple(tuple(part) if isinstance(part, list) else part for part in gate)
+        for gate in gates
+    )
+
+@functools.lru_cache(maxsize=128)
+def _build_circuit(gates_tuple: tuple, qubits: int) -> QuantumCircuit:
+    """Rebuild a QuantumCircuit from a frozen gate tuple. Cached; callers must not mutate the result."""
+    circuit = QuantumCircuit(qubits, qubits)
+    for gate in gates_tuple:
+        apply = _APPLY_GATE.get(gate[0])
+        if apply is None:
+            raise ValueError(f"Unknown gate: {gate[0]}")
+        apply(circuit, gate, qubits)
+    return circuit
+
+@functools.lru_cache(maxsize=128)
+def _transpile(gates_tuple: tuple, qubits: int) -> QuantumCircuit:
+    """Compile the circuit for a gate tuple to the simulator's basis. Cached on (gates, qubits)."""
+    return transpile(_build_circuit(gates_tuple, qubits), SIMULATOR, optimization_level=1)
+
+def _has_only_final_measurements(gates_tuple):
+    """True if no gate follows a measurement, so the circuit can be sampled from its statevector."""
+    measured = False
+    for gate in gates_tuple:
+        if gate[0] == "Measure":
+            measured = True
+        elif measured:
+            return False
+    return True
+
+@functools.lru_cache(maxsize=128)
+def _probabilities(gates_tuple: tuple, qubits: int):
+    """Outcome probabilities of the measurement-free circuit. Cached on (gates, qubits)."""
+    unitary_gates = tuple(gate for gate in gates_tuple if gate[0] != "Measure")
+    probs = Statevector.from_instruction(_build_circuit(unitary_gates, qubits)).probabilities()
+    return probs / probs.sum()
+
+def _sample_counts(gates_tuple, qubits, shots):
+    """Sample measurement counts for a circuit whose measurements are all at the end."""
+    draws = np.random.multinomial(shots, _probabilities(gates_tuple, qubits))
+    return {format(i, f"0{qubits}b"): int(n) for i, n in enumerate(draws) if n}
+
+def _run_counts(gates_tuple, qubits, shots):
+    """Simulate `shots` runs of the circuit and return its measurement counts."""
+    if _has_only_final_measurements(gates_tuple):
+        # Small circuits: sampling the statevector avoids the Aer round trip
+        return _sample_counts(gates_tuple, qubits, shots)
+    compiled = _transpile(gates_tuple, qubits)
+    result = SIMULATOR.run(compiled, shots=shots).result()
+    return result.get_counts(compiled)
+
+@functools.lru_cache(maxsize=128)
+def _render_circuit_png(gates_tuple: tuple, qubits: int) -> bytes:
+    """Render the circuit for a gate tuple to PNG bytes. Cached on (gates, qubits)."""
+    circuit = _build_circuit(gates_tuple, qubits)
+    buf = io.BytesIO()
+    with _MPL_LOCK:
+        plt = _pyplot()
+        fig = circuit.draw(output='mpl')
+        fig.savefig(buf, format='png', bbox_inches='tight')
+        plt.close(fig)
+    return buf.getvalue()
+
+def _circuit_version(gates_tuple, qubits):
+    """Stable token identifying a circuit, used as the PNG's ETag and cache-busting query."""
+    return hashlib.sha1(repr((gates_tuple, qubits)).encode()).hexdigest()[:16]
+
+def _circuit_png_url(session):
+    version = _circuit_version(_freeze_gates(session.gates), session.qubits)
+    return f"/circuit.png?v={version}"
+
+def _circuit_text(gates, qubits):
+    """Render a gate list for `qubits` qubits as a text diagram."""
     try:
-        logger.debug("Generating plot for %s", "histogram" if is_histogram else "circuit")
-        plt.figure()
-        if is_histogram:
-            plot_histogram(circuit).figure
-        else:
-            circuit.draw(output='mpl')
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight')
-        plt.close()
-        buf.seek(0)
-        img_data = base64.b64encode(buf.read()).decode('utf-8')
-        logger.debug("Plot generated successfully")
-        return img_data
+        logger.debug("Generating text circuit diagram")
+        return str(_build_circuit(_freeze_gates(gates), qubits).draw(output='text'))
     except Exception as e:
-        logger.error(f"Error in circuit_to_base64 (is_histogram={is_histogram}): {str(e)}")
+        logger.error(f"Error in _circuit_text: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to generate image: {str(e)}")
 
+# example name -> (gates, valid qubit counts, error for other qubit counts)
+EXAMPLES = {
+    ExampleName.BELL: (
+        (("H", 0), ("CX", 0, 1)), range(2, MAX_QUBITS + 1), "Bell State requires at least 2 qubits",
+    ),
+    ExampleName.GROVER: (
+        (("H", (0, 1)), ("Grover Operator", (0, 1))), range(2, 3), "Grover's example requires exactly 2 qubits",
+    ),
+}
+
+def _warm_renderer():
+    """Prime matplotlib's caches and pre-render the example diagrams."""
+    with _MPL_LOCK:
+        plt = _pyplot()
+        QuantumCircuit(1).draw(output='mpl')
+        plt.close('all')
+    for gates, valid_qubits, _ in EXAMPLES.values():
+        for qubits in valid_qubits:
+            _render_circuit_png(gates, qubits)
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root():
-    try:
-        with open("templates/index.html", "r") as f:
-            return HTMLResponse(content=f.read())
-    except Exception as e:
-        logger.error(f"Error serving index.html: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to load index.html")
+    return HTMLResponse(content=_INDEX_HTML)
 
-@app.get("/reset")
-async def reset_circuit(qubits: int):
+@app.get("/reset", response_model=CircuitResponse)
+async def reset_circuit(qubits: int, session: SessionState = Depends(get_session, scope="function")):
     try:
-        if not (1 <= qubits <= 5):
-            raise HTTPException(status_code=400, detail="Qubits must be between 1 and 5")
-        circuit_state["qubits"] = qubits
-        circuit_state["circuit"] = QuantumCircuit(qubits, qubits)
-        circuit_state["gates"] = []
-        logger.debug(f"Circuit reset with {qubits} qubits")
-        return {"gates": circuit_state["gates"], "circuit_image": None}
+        if not (1 <= qubits <= MAX_QUBITS):
+            raise HTTPException(status_code=400, detail=f"Qubits must be between 1 and {MAX_QUBITS}")
+        session.qubits = qubits
+        session.gates = []
+        session.remember_circuit_image(None, "text")
+        logger.debug("Circuit reset with %d qubits", qubits)
+        return {"gates": session.gates, "circuit_image": None}
     except Exception as e:
         logger.error(f"Error in reset_circuit: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to reset circuit: {str(e)}")
 
-@app.get("/load_example")
-async def load_example(example: str, qubits: int):
+@app.get("/load_example", response_model=CircuitResponse)
+async def load_example(example: ExampleName, qubits: int, session: SessionState = Depends(get_session, scope="function")):
     try:
-        if not (1 <= qubits <= 5):
-            raise HTTPException(status_code=400, detail="Qubits must be between 1 and 5")
-        circuit_state["qubits"] = qubits
-        circuit_state["circuit"] = QuantumCircuit(qubits, qubits)
-        circuit_state["gates"] = []
-
-        if example == "Bell State (Entanglement)":
-            if qubits < 2:
-                raise HTTPException(status_code=400, detail="Bell State requires at least 2 qubits")
-            circuit_state["circuit"].h(0)
-            circuit_state["circuit"].cx(0, 1)
-            circuit_state["gates"] = [("H", 0), ("CX", 0, 1)]
-        elif example == "Grover's Algorithm (2-Qubit Search)":
-            if qubits != 2:
-                raise HTTPException(status_code=400, detail="Grover's example requires exactly 2 qubits")
-            oracle = QuantumCircuit(2)
-            oracle.cz(0, 1)
-            grover_op = GroverOperator(oracle)
-            circuit_state["circuit"].h([0, 1])
-            circuit_state["circuit"].append(grover_op, [0, 1])
-            circuit_state["gates"] = [("H", [0, 1]), ("Grover Operator", [0, 1])]
-        else:
-            raise HTTPException(status_code=400, detail="Invalid example")
-
-        circuit_image = circuit_to_base64(circuit_state["circuit"])
-        logger.debug(f"Loaded example: {example}")
-        return {"gates": circuit_state["gates"], "circuit_image": circuit_image}
+        if not (1 <= qubits <= MAX_QUBITS):
+            raise HTTPException(status_code=400, detail=f"Qubits must be between 1 and {MAX_QUBITS}")
+        session.qubits = qubits
+        session.gates = []
+        session.remember_circuit_image(None, "text")
+
+        gates, valid_qubits, qubits_error = EXAMPLES[example]
+        if qubits not in valid_qubits:
+            raise HTTPException(status_code=400, detail=qubits_error)
+        session.gates = list(gates)
+
+        circuit_image = _circuit_png_url(session)
+        logger.debug("Loaded example: %s", example.value)
+        session.remember_circuit_image(circuit_image, "png")
+        return {"gates": session.gates, "circuit_image": circuit_image, "circuit_format": "png"}
     except Exception as e:
         logger.error(f"Error in load_example: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to load example: {str(e)}")
 
-@app.post("/add_gate")
-async def add_gate(request: GateRequest):
+@app.get("/render_png", response_model=CircuitResponse)
+async def render_png(session: SessionState = Depends(find_session)):
+    try:
+        if not session.gates:
+            raise HTTPException(status_code=400, detail="No circuit defined")
+        circuit_image = _circuit_png_url(session)
+        logger.debug("Rendered circuit PNG")
+        session.remember_circuit_image(circuit_image, "png")
+        return {"gates": session.gates, "circuit_image": circuit_image, "circuit_format": "png"}
+    except Exception as e:
+        logger.error(f"Error in render_png: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to render circuit: {str(e)}")
+
+@app.get("/circuit.png")
+async def circuit_png(request: Request, session: SessionState = Depends(find_session)):
     try:
-        logger.debug(f"Received add_gate payload: {request.dict()}")
-        if circuit_state["circuit"] is None or circuit_state["qubits"] != request.qubits:
-            circuit_state["qubits"] = request.qubits
-            circuit_state["circuit"] = QuantumCircuit(request.qubits, request.qubits)
-            circuit_state["gates"] = []
+        gates_tuple = _freeze_gates(session.gates)
+        etag = f'"{_circuit_version(gates_tuple, session.qubits)}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        png_bytes = await asyncio.to_thread(_render_circuit_png, gates_tuple, session.qubits)
+        return Response(content=png_bytes, media_type="image/png", headers=headers)
+    except Exception as e:
+        logger.error(f"Error in circuit_png: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to render circuit: {str(e)}")
+
+@app.post("/add_gate", response_model=CircuitResponse)
+async def add_gate(request: GateRequest, session: SessionState = Depends(get_session, scope="function")):
+    try:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received add_gate payload: %s", request.model_dump())
+        if session.qubits != request.qubits:
+            session.qubits = request.qubits
+            session.gates = []
 
-        if request.gate_type not in ["H (Hadamard)", "X (Pauli-X)", "CX (CNOT)", "CZ (Controlled-Z)", "Measure"]:
-            raise HTTPException(status_code=400, detail="Invalid gate type")
+        spec = GATE_DISPATCH[request.gate_type]
 
-        if request.gate_type != "Measure":
+        if spec.needs_target:
             if request.target_qubit is None or not (0 <= request.target_qubit < request.qubits):
                 raise HTTPException(status_code=400, detail="Invalid target qubit")
-            if request.gate_type in ["CX (CNOT)", "CZ (Controlled-Z)"]:
-                if request.control_qubit is None or not (0 <= request.control_qubit < request.qubits):
-                    raise HTTPException(status_code=400, detail="Invalid control qubit")
-                if request.control_qubit == request.target_qubit:
-                    raise HTTPException(status_code=400, detail="Control and target qubits must be different")
-
-        if request.gate_type == "H (Hadamard)":
-            circuit_state["circuit"].h(request.target_qubit)
-            circuit_state["gates"].append(("H", request.target_qubit))
-        elif request.gate_type == "X (Pauli-X)":
-            circuit_state["circuit"].x(request.target_qubit)
-            circuit_state["gates"].append(("X", request.target_qubit))
-        elif request.gate_type == "CX (CNOT)":
-            circuit_state["circuit"].cx(request.control_qubit, request.target_qubit)
-            circuit_state["gates"].append(("CX", request.control_qubit, request.target_qubit))
-        elif request.gate_type == "CZ (Controlled-Z)":
-            circuit_state["circuit"].cz(request.control_qubit, request.target_qubit)
-            circuit_state["gates"].append(("CZ", request.control_qubit, request.target_qubit))
-        elif request.gate_type == "Measure":
-            circuit_state["circuit"].measure(range(request.qubits), range(request.qubits))
-            circuit_state["gates"].append(("Measure", "All"))
-
-        circuit_image = circuit_to_base64(circuit_state["circuit"])
-        logger.debug(f"Added gate: {request.gate_type}")
-        return {"gates": circuit_state["gates"], "circuit_image": circuit_image}
+        if spec.needs_control:
+            if request.control_qubit is None or not (0 <= request.control_qubit < request.qubits):
+                raise HTTPException(status_code=400, detail="Invalid control qubit")
+            if request.control_qubit == request.target_qubit:
+                raise HTTPException(status_code=400, detail="Control and target qubits must be different")
+
+        session.gates.append(spec.record(request.target_qubit, request.control_qubit))
+
+        circuit_image = await asyncio.to_thread(_circuit_text, _freeze_gates(session.gates), session.qubits)
+        logger.debug("Added gate: %s", request.gate_type.value)
+        session.remember_circuit_image(circuit_image, "text")
+        return {"gates": session.gates, "circuit_image": circuit_image, "circuit_format": "text"}
     except Exception as e:
         logger.error(f"Error in add_gate: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to add gate: {str(e)}")
 
-@app.get("/simulate")
-async def simulate_circuit(shots: int):
+@app.get("/simulate", response_model=SimulationResponse)
+async def simulate_circuit(shots: int, session: SessionState = Depends(find_session)):
     try:
         if not (100 <= shots <= 10000):
             raise HTTPException(status_code=400, detail="Shots must be between 100 and 10000")
-        if circuit_state["circuit"] is None:
-            raise HTTPException(status_code=400, detail="No circuit defined")
 
-        # Add measurement if not present
-        if "Measure" not in [g[0] for g in circuit_state["gates"]]:
-            circuit_state["circuit"].measure(range(circuit_state["qubits"]), range(circuit_state["qubits"]))
-            circuit_state["gates"].append(("Measure", "All"))
+        # Add measurement if not present; the cached image no longer matches the gates
+        if "Measure" not in [g[0] for g in session.gates]:
+            session.gates.append(("Measure", "All"))
+            session.last_circuit_image = None
 
-        simulator = AerSimulator()
-        logger.debug(f"Running simulation with {shots} shots")
-        result = simulator.run(circuit_state["circuit"], shots=shots).result()
-        counts = result.get_counts(circuit_state["circuit"])
-        logger.debug(f"Simulation results: {counts}")
+        logger.debug("Running simulation with %d shots", shots)
+        gates_tuple = _freeze_gates(session.gates)
+        # Simulation and rendering are synchronous; run them off the event loop
+        counts = await asyncio.to_thread(_run_counts, gates_tuple, session.qubits, shots)
+        logger.debug("Simulation results: %s", counts)
 
-        circuit_image = circuit_to_base64(circuit_state["circuit"])
-        histogram_image = circuit_to_base64(counts, is_histogram=True)
-        return {"circuit_image": circuit_image, "histogram_image": histogram_image}
+        if session.last_circuit_image is None:
+            # Keep showing the diagram in the format the user last saw
+            if session.last_circuit_format == "png":
+                session.remember_circuit_image(_circuit_png_url(session), "png")
+            else:
+                circuit_image = await asyncio.to_thread(_circuit_text, gates_tuple, session.qubits)
+                session.remember_circuit_image(circuit_image, "text")
+        return {
+            "circuit_image": session.last_circuit_image,
+            "circuit_format": session.last_circuit_format,
+            "counts": counts,
+            "shots": shots,
+        }
     except Exception as e:
         logger.error(f"Error in simulate_circuit: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to simulate circuit: {str(e)}")
\ No newline at end of file